@@ -1,30 +1,50 @@
 import csv
 import email_validator
+import heapq
+import json
 import os
+import queue
+import re
+import resource
 import smtplib
+import ssl
+import tempfile
+import threading
+import time
+import tracemalloc
 import yaml
 
-from dataclasses import dataclass
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 from email.message import EmailMessage
 from enum import Enum, auto
 from ftfcu_appworx import Apwx, JobTime
 from jinja2 import Environment, FileSystemLoader
 from oracledb import Connection as DbConnection
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 from zoneinfo import ZoneInfo
 
 _version_ = 1.00
 
+# Watermark used before the first incremental run, earlier than any CLOSEDATE
+WATERMARK_START = "01/01/1900"
+
 
 class AppWorxEnum(Enum):
     """Define AppWorx arguments here to avoid hard-coded strings"""
 
     TNS_SERVICE_NAME = auto()
+    BACKFILL_END_DATE = auto()
     CONFIG_FILE_PATH = auto()
+    DB_FETCH_PARTITIONS = auto()
     EFFDATE = auto()
     FROM_EMAIL_ADDR = auto()
+    FULL_RESCAN_YN = auto()
+    MEMORY_PROFILE_YN = auto()
     MINOR_CODES = auto()
     OUTPUT_FILE_PATH = auto()
     OUTPUT_FILE_NAME = auto()
@@ -33,12 +53,141 @@ class AppWorxEnum(Enum):
     SMTP_PORT = auto()
     SMTP_USER = auto()
     SMTP_PASSWORD = auto()
+    SMTP_MAX_CONNECTIONS = auto()
+    SMTP_DOMAIN_CONCURRENCY = auto()
+    SMTP_DOMAIN_RATE = auto()
+    SMTP_TLS_CA_FILE = auto()
+    SMTP_TLS_VERIFY_YN = auto()
     TEST_EMAIL_ADDR = auto()
+    WATERMARK_FILE = auto()
 
     def _str_(self):
         return self.name
 
 
+class TlsSessionCache:
+    """Keeps the most recent TLS session per SMTP relay so that reconnects, serial
+    or parallel, can resume it instead of doing a full handshake"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: dict[tuple[str, int], ssl.SSLSession] = {}
+        self.handshakes = 0
+        self.resumed = 0
+
+    def get(self, host: str, port: int) -> Optional[ssl.SSLSession]:
+        with self._lock:
+            return self._sessions.get((host, port))
+
+    def record(self, host: str, port: int, sock: ssl.SSLSocket):
+        """Count a completed handshake and remember its session for the next one"""
+        with self._lock:
+            self.handshakes += 1
+            if sock.session_reused:
+                self.resumed += 1
+            if sock.session is not None:
+                self._sessions[(host, port)] = sock.session
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            return self.resumed / self.handshakes if self.handshakes else 0.0
+
+
+class DbSessionPool:
+    """Fixed set of DNA sessions for partitioned fetches. The sessions are opened
+    with dna_db_connect so they get the same credentials, DSN and Oracle client
+    setup as the main connection"""
+
+    def __init__(self, connections: list[DbConnection]):
+        self._connections = connections
+        self._idle = queue.Queue()
+        for conn in connections:
+            self._idle.put(conn)
+
+    @contextmanager
+    def acquire(self):
+        conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+
+
+class ResumableSMTP(smtplib.SMTP):
+    """SMTP client whose STARTTLS upgrade can resume an earlier TLS session"""
+
+    def starttls(
+        self,
+        context: Optional[ssl.SSLContext] = None,
+        session: Optional[ssl.SSLSession] = None,
+    ):
+        """Same as smtplib.SMTP.starttls, but hands the session to wrap_socket"""
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("starttls"):
+            raise smtplib.SMTPNotSupportedError(
+                "STARTTLS extension not supported by server."
+            )
+        if context is None:
+            context = ssl.create_default_context()
+        resp, reply = self.docmd("STARTTLS")
+        if resp != 220:
+            raise smtplib.SMTPResponseException(resp, reply)
+
+        self.sock = context.wrap_socket(
+            self.sock, server_hostname=self._host, session=session
+        )
+        # The server's capabilities must be re-read over the encrypted channel
+        self.file = None
+        self.helo_resp = None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return resp, reply
+
+
+class SmtpSessionPool:
+    """Authenticated SMTP sessions kept open for the whole run and shared by the
+    delivery workers, so a message costs a MAIL/RCPT/DATA exchange instead of a
+    new connection, STARTTLS and login. A session is only opened when every open
+    one is busy, so there are never more than SMTP_MAX_CONNECTIONS"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self.sessions_opened = 0
+
+    def acquire(self, connect: Callable[[], ResumableSMTP]) -> ResumableSMTP:
+        """An idle session, or a new one from connect() when none is idle"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.open(connect)
+
+    def open(self, connect: Callable[[], ResumableSMTP]) -> ResumableSMTP:
+        server = connect()
+        with self._lock:
+            self.sessions_opened += 1
+        return server
+
+    def release(self, server: ResumableSMTP):
+        self._idle.put(server)
+
+    def close(self):
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+
 @dataclass
 class ScriptData:
     """Class that holds all the structures and data needed by the script"""
@@ -47,14 +196,205 @@ class ScriptData:
     dbh: DbConnection
     config: Any
     email_template: Any
+    ssl_context: ssl.SSLContext
+    tls_sessions: TlsSessionCache = field(default_factory=TlsSessionCache)
+    smtp_sessions: SmtpSessionPool = field(default_factory=SmtpSessionPool)
+    db_pool: Optional[DbSessionPool] = None
+
+
+@dataclass
+class DomainLimit:
+    """Delivery limits for one recipient domain. A rate of 0 means unlimited"""
+
+    concurrency: int = 1
+    rate: float = 0.0
+
+    def __post_init__(self):
+        # A domain that may never have a message in flight would hang the run
+        if self.concurrency < 1:
+            raise ValueError(
+                f"Domain concurrency must be at least 1, got {self.concurrency}"
+            )
+        if self.rate < 0:
+            raise ValueError(f"Domain rate must not be negative, got {self.rate}")
+
+
+class DeliveryScheduler:
+    """Sends queued messages round-robin across recipient domains, keeping each
+    domain within its concurrency and rate (messages per second) limits so that
+    one busy domain neither gets throttled nor holds up the others"""
+
+    def __init__(
+        self,
+        max_workers: int,
+        default_limit: DomainLimit,
+        domain_limits: Optional[dict[str, DomainLimit]] = None,
+    ):
+        if max_workers < 1:
+            raise ValueError(
+                f"SMTP_MAX_CONNECTIONS must be at least 1, got {max_workers}"
+            )
+        self.max_workers = max_workers
+        self.default_limit = default_limit
+        self.domain_limits = domain_limits or {}
+
+    def limit_for(self, domain: str) -> DomainLimit:
+        return self.domain_limits.get(domain, self.default_limit)
+
+    def run(
+        self,
+        items: list,
+        domain_of: Callable[[Any], str],
+        send: Callable[[Any], None],
+    ):
+        """Call send(item) for every item, grouping items by domain_of(item)"""
+        queues: dict[str, deque] = {}
+        for item in items:
+            queues.setdefault(domain_of(item), deque()).append(item)
+        domains = deque(queues)
+        in_flight = {domain: 0 for domain in queues}
+        next_send_at = {domain: 0.0 for domain in queues}
+        active = 0
+        errors = []
+        condition = threading.Condition()
+
+        def deliver(domain: str, item: Any):
+            nonlocal active
+            try:
+                send(item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with condition:
+                    in_flight[domain] -= 1
+                    active -= 1
+                    condition.notify()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            with condition:
+                while domains:
+                    if active >= self.max_workers:
+                        condition.wait()
+                        continue
+
+                    # Visit each domain at most once looking for one that may send
+                    wait_seconds = None
+                    for _ in range(len(domains)):
+                        domain = domains[0]
+                        domains.rotate(-1)
+                        limit = self.limit_for(domain)
+                        now = time.monotonic()
+                        if in_flight[domain] >= limit.concurrency:
+                            continue
+                        if next_send_at[domain] > now:
+                            delay = next_send_at[domain] - now
+                            wait_seconds = min(wait_seconds or delay, delay)
+                            continue
+
+                        item = queues[domain].popleft()
+                        if not queues[domain]:
+                            # The domain just visited is now at the right end
+                            domains.pop()
+                        in_flight[domain] += 1
+                        active += 1
+                        if limit.rate:
+                            next_send_at[domain] = now + 1 / limit.rate
+                        executor.submit(deliver, domain, item)
+                        break
+                    else:
+                        condition.wait(timeout=wait_seconds)
+
+        if errors:
+            raise errors[0]
+
+
+class MemoryProfiler:
+    """Opt-in tracemalloc instrumentation of the stages of a run. When disabled
+    every method is a no-op so it can stay wired into run()"""
+
+    MIB = 1024 * 1024
+
+    def __init__(self, enabled: bool, top_n: int = 10):
+        self.enabled = enabled
+        self.top_n = top_n
+        self.peak_bytes = 0
+        self.stage_peak_bytes: dict[str, int] = {}
+        self._snapshot = None
+        if enabled:
+            tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot() if top_n else None
+
+    def checkpoint(self, stage: str):
+        """Record current and peak traced memory since the previous checkpoint and
+        print the allocation sites that grew the most during the stage"""
+        if not self.enabled:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.peak_bytes = max(self.peak_bytes, peak)
+        self.stage_peak_bytes[stage] = peak
+        print(
+            f"Memory after {stage}: current {current / self.MIB:.1f} MiB, "
+            f"stage peak {peak / self.MIB:.1f} MiB, "
+            f"peak RSS {peak_rss_bytes() / self.MIB:.1f} MiB"
+        )
+        if self.top_n:
+            snapshot = tracemalloc.take_snapshot()
+            self._print_top_allocations(snapshot.compare_to(self._snapshot, "lineno"))
+            self._snapshot = snapshot
+
+    def report(self, account_count: int) -> float:
+        """Print bytes per account and stop tracing. Returns bytes per account.
+        Only allocations made after the profiler was created are counted"""
+        if not self.enabled or not tracemalloc.is_tracing():
+            return 0.0
+        tracemalloc.stop()
+        bytes_per_account = self.peak_bytes / account_count if account_count else 0.0
+        print(
+            f"Memory peak {self.peak_bytes / self.MIB:.1f} MiB for {account_count} "
+            f"accounts ({bytes_per_account:.0f} bytes per account), "
+            f"peak RSS {peak_rss_bytes() / self.MIB:.1f} MiB"
+        )
+        return bytes_per_account
+
+    def _print_top_allocations(self, stats: list[tracemalloc.StatisticDiff]):
+        for stat in stats[: self.top_n]:
+            frame = stat.traceback[0]
+            print(
+                f"    {frame.filename}:{frame.lineno}: "
+                f"{stat.size_diff / 1024:+.1f} KiB ({stat.count_diff:+} blocks)"
+            )
 
 
 def run(apwx: Apwx):
     """The main logic of the script goes here"""
-    script_data = initialize(apwx)
-    accounts = get_closed_accounts(script_data)
-    process_records(script_data, accounts)
-    write_audit_log(script_data, accounts)
+    profiler = MemoryProfiler(memory_profile_enabled(apwx))
+    script_data = None
+    account_count = 0
+    try:
+        script_data = initialize(apwx)
+        profiler.checkpoint("initialize")
+
+        # A backfill runs every EFFDATE in its range on the same connections, and
+        # an email sent for one EFFDATE is not sent again for a later one
+        email_sent = set()
+        accounts_sent = read_sent_accounts(apwx)
+        for effdate in get_effdates(apwx):
+            accounts = get_closed_accounts(script_data, effdate)
+            profiler.checkpoint(f"get_closed_accounts {effdate}")
+            process_records(script_data, accounts, email_sent, accounts_sent)
+            profiler.checkpoint(f"process_records {effdate}")
+            write_audit_log(script_data, accounts, effdate)
+            profiler.checkpoint(f"write_audit_log {effdate}")
+            advance_watermark(script_data, accounts)
+            account_count += len(accounts)
+
+        print_tls_stats(script_data)
+    finally:
+        # Also stops tracing and closes the extra sessions when a stage fails
+        profiler.report(account_count)
+        if script_data is not None:
+            close_connections(script_data)
 
     return True
 
@@ -71,6 +411,14 @@ def parse_args(apwx: Apwx) -> Apwx:
     parser.add_arg(
         str(AppWorxEnum.CONFIG_FILE_PATH), type=r"(.yml|.yaml)$", required=True
     )
+    parser.add_arg(
+        str(AppWorxEnum.BACKFILL_END_DATE),
+        type=r"\d{2}[-\.\\/]\d{2}[-\.\\/]\d{4}",
+        required=False,
+    )
+    parser.add_arg(
+        str(AppWorxEnum.DB_FETCH_PARTITIONS), type=int, default=1, required=False
+    )
     parser.add_arg(
         str(AppWorxEnum.EFFDATE), type=r"\d{2}[-\.\\/]\d{2}[-\.\\/]\d{4}", required=True
     )
@@ -80,6 +428,18 @@ def parse_args(apwx: Apwx) -> Apwx:
         required=False,
         default="member.communications@firsttechfed.com",
     )
+    parser.add_arg(
+        str(AppWorxEnum.FULL_RESCAN_YN),
+        choices=["Y", "N"],
+        default="N",
+        required=False,
+    )
+    parser.add_arg(
+        str(AppWorxEnum.MEMORY_PROFILE_YN),
+        choices=["Y", "N"],
+        default="N",
+        required=False,
+    )
     parser.add_arg(
         str(AppWorxEnum.MINOR_CODES),
         type=str,
@@ -113,11 +473,36 @@ def parse_args(apwx: Apwx) -> Apwx:
         type=str,
         required=True,
     )
+    parser.add_arg(
+        str(AppWorxEnum.SMTP_MAX_CONNECTIONS), type=int, default=1, required=False
+    )
+    parser.add_arg(
+        str(AppWorxEnum.SMTP_DOMAIN_CONCURRENCY), type=int, default=1, required=False
+    )
+    parser.add_arg(
+        str(AppWorxEnum.SMTP_DOMAIN_RATE), type=float, default=0, required=False
+    )
+    parser.add_arg(
+        str(AppWorxEnum.SMTP_TLS_CA_FILE),
+        type=str,
+        required=False,
+    )
+    parser.add_arg(
+        str(AppWorxEnum.SMTP_TLS_VERIFY_YN),
+        choices=["Y", "N"],
+        default="Y",
+        required=False,
+    )
     parser.add_arg(
         str(AppWorxEnum.TEST_EMAIL_ADDR),
         type=str,
         required=False,
     )
+    parser.add_arg(
+        str(AppWorxEnum.WATERMARK_FILE),
+        type=str,
+        required=False,
+    )
     apwx.parse_args()
     return apwx
 
@@ -125,26 +510,66 @@ def parse_args(apwx: Apwx) -> Apwx:
 def initialize(apwx) -> ScriptData:
     """Initialize objects required by the script to call external systems"""
     config = get_config(apwx)
+    # An incomplete partition config fails here, before any session is opened
+    fetch_partitioned = partitioned_fetch_enabled(apwx, config)
     return ScriptData(
         apwx=apwx,
         dbh=dna_db_connect(apwx),
         config=config,
         email_template=get_email_template(config),
+        ssl_context=get_ssl_context(apwx),
+        db_pool=dna_db_pool(apwx) if fetch_partitioned else None,
     )
 
 
-def get_closed_accounts(script_data: ScriptData) -> list[dict]:
+def close_connections(script_data: ScriptData):
+    """Close the connections opened for the run besides the main DNA connection"""
+    script_data.smtp_sessions.close()
+    if script_data.db_pool is not None:
+        script_data.db_pool.close()
+
+
+def get_effdates(apwx: Apwx) -> list[str]:
+    """EFFDATE alone, or every date from EFFDATE to BACKFILL_END_DATE inclusive"""
+    if not apwx.args.BACKFILL_END_DATE:
+        return [apwx.args.EFFDATE]
+
+    start_date = parse_effdate(apwx.args.EFFDATE)
+    end_date = parse_effdate(apwx.args.BACKFILL_END_DATE)
+    if end_date < start_date:
+        raise ValueError(
+            f"BACKFILL_END_DATE {apwx.args.BACKFILL_END_DATE} is before "
+            f"EFFDATE {apwx.args.EFFDATE}"
+        )
+    day_count = (end_date - start_date).days + 1
+    effdates = [
+        (start_date + timedelta(days=day)).strftime("%m/%d/%Y")
+        for day in range(day_count)
+    ]
+    print(f"Backfilling {day_count} days from {effdates[0]} to {effdates[-1]}")
+    return effdates
+
+
+def parse_effdate(effdate: str) -> datetime:
+    """Parses an MM/DD/YYYY date written with any separator the arguments accept"""
+    return datetime.strptime(re.sub(r"[-\.\\]", "/", effdate), "%m/%d/%Y")
+
+
+def get_closed_accounts(
+    script_data: ScriptData, effdate: Optional[str] = None
+) -> list[dict]:
     """Get closed accounts starting at a specified date"""
     print("Getting Closed Account List")
     query = script_data.config["get_closed_accounts"]
-    effdate = script_data.apwx.args.EFFDATE
+    effdate = effdate or script_data.apwx.args.EFFDATE
     minor_codes = format_minor_codes(script_data.apwx.args.MINOR_CODES)
 
     query_params = {"effdate": effdate}
     # Not possible to provide list of values in an IN clause as a bind variables.
     # String substitution is the only option here.
     query = query.replace("{{minor_codes}}", minor_codes)
-    accounts = execute_sql_select(script_data.dbh, query, query_params)
+    query = apply_watermark(script_data, query, query_params)
+    accounts = execute_partitioned_select(script_data, query, query_params)
     for account in accounts:
         print(f"Closed account: {account['ACCTNBR']}")
 
@@ -152,14 +577,28 @@ def get_closed_accounts(script_data: ScriptData) -> list[dict]:
     return accounts
 
 
-def process_records(script_data: ScriptData, accounts: list[dict]):
-    """Send emails for each closed account"""
+def process_records(
+    script_data: ScriptData,
+    accounts: list[dict],
+    email_sent: Optional[set] = None,
+    accounts_sent: Optional[set] = None,
+):
+    """Send emails for each closed account. email_sent holds the addresses already
+    emailed by this run and is updated with the ones queued here. accounts_sent
+    holds the ACCTNBRs an earlier run emailed on a day the watermark held back"""
     print("Process Closed Account List")
-    email_sent = set()
+    email_sent = set() if email_sent is None else email_sent
+    accounts_sent = accounts_sent or set()
+    queued = []
     for account in accounts:
         account["RESULT"] = ""
         account["EXCPYN"] = False
 
+        if account.get("ACCTNBR") in accounts_sent:
+            account["RESULT"] = "Email Already Sent"
+            email_sent.add(account.get("EMAILADDR"))
+            continue
+
         if account.get("EMAILADDR") in email_sent:
             account["RESULT"] = "Email Already Sent"
             continue
@@ -180,22 +619,35 @@ def process_records(script_data: ScriptData, accounts: list[dict]):
             continue
 
         if not account["EXCPYN"]:
-            successful, message = send_email(script_data, account)
             email_sent.add(account.get("EMAILADDR"))
-            account["EXCPYN"] = not successful
-            account["RESULT"] = message
+            queued.append(account)
 
+    def deliver(account: dict):
+        successful, message = send_email(script_data, account)
+        account["EXCPYN"] = not successful
+        account["RESULT"] = message
 
-def write_audit_log(script_data: ScriptData, accounts: list[dict]):
+    print(f"Sending {len(queued)} emails")
+    get_delivery_scheduler(script_data).run(
+        queued, lambda account: recipient_domain(script_data, account), deliver
+    )
+
+
+def write_audit_log(
+    script_data: ScriptData, accounts: list[dict], effdate: Optional[str] = None
+):
     """Generate the output report file"""
     print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: Write audit log")
     apwx = script_data.apwx
-    output_file_path = Path(apwx.args.OUTPUT_FILE_PATH) / apwx.args.OUTPUT_FILE_NAME
+    effdate = effdate or apwx.args.EFFDATE
+    output_file_path = Path(apwx.args.OUTPUT_FILE_PATH) / audit_log_file_name(
+        apwx, effdate
+    )
     with open(output_file_path, "w", encoding="utf-8", newline="") as file:
         csv_writer = csv.writer(file)
         csv_writer.writerow(["CONSUMER CLOSED LOANS EMAIL AUDIT LOG"])
         csv_writer.writerow([f"RUN DATE: {today_date()}"])
-        csv_writer.writerow([f"EFFDATE: {apwx.args.EFFDATE}"])
+        csv_writer.writerow([f"EFFDATE: {effdate}"])
         csv_writer.writerow([])
 
         csv_writer.writerow(["EMAILS SENT"])
@@ -210,6 +662,224 @@ def write_audit_log(script_data: ScriptData, accounts: list[dict]):
         csv_writer.writerow(["END"])
 
 
+def execute_partitioned_select(
+    script_data: ScriptData, query: str, query_params: dict
+) -> list[dict]:
+    """Run the query as DB_FETCH_PARTITIONS concurrent slices on the session pool
+    and merge the slices back into the order of a single query.
+
+    The query marks where the slice restriction goes with {{partition_predicate}}
+    and the config supplies it in terms of :partition_count and :partition_index,
+    e.g. "AND MOD(a.ACCTNBR, :partition_count) = :partition_index". Every slice
+    keeps the query's ORDER BY, and partition_merge_keys in the config names the
+    result columns that reproduce it (ascending, nulls last). Their values must
+    sort in Python the way Oracle sorts them, so use numbers or DATE columns.
+    The query returns CLOSEDATE as an MM/DD/YYYY string, which other code relies
+    on and which does not sort across years, so ordering on the closing date
+    needs the raw DATE selected as an extra column just for the merge, e.g.
+        SELECT ..., a.CLOSEDATE AS CLOSEDATE_SORT ... ORDER BY a.CLOSEDATE, a.ACCTNBR
+        partition_merge_keys: [CLOSEDATE_SORT, ACCTNBR]
+    Otherwise the single-query order, and with it which duplicate of an email
+    address gets sent by process_records, is silently not reproduced.
+
+    The slices run on different sessions and would each see the data as of their
+    own start. To keep the single query's read consistency, the SCN is read once
+    on the main connection and every slice reads as of it through DBMS_FLASHBACK,
+    which needs EXECUTE on DBMS_FLASHBACK and undo retention covering the fetch.
+    """
+    partition_count = int(script_data.apwx.args.DB_FETCH_PARTITIONS)
+    if script_data.db_pool is None:
+        query = query.replace("{{partition_predicate}}", "")
+        return execute_sql_select(script_data.dbh, query, query_params)
+
+    config = script_data.config
+    query = query.replace("{{partition_predicate}}", config["partition_predicate"])
+    scn = current_scn(script_data.dbh)
+
+    def fetch_partition(partition_index: int) -> list[dict]:
+        partition_params = {
+            **query_params,
+            "partition_count": partition_count,
+            "partition_index": partition_index,
+        }
+        with script_data.db_pool.acquire() as conn, read_as_of_scn(conn, scn):
+            return execute_sql_select(conn, query, partition_params)
+
+    print(f"Fetching in {partition_count} partitions as of SCN {scn}")
+    with ThreadPoolExecutor(max_workers=partition_count) as executor:
+        partitions = list(executor.map(fetch_partition, range(partition_count)))
+
+    merge_keys = config["partition_merge_keys"]
+    return list(
+        heapq.merge(
+            *partitions,
+            key=lambda row: tuple((row[key] is None, row[key]) for key in merge_keys),
+        )
+    )
+
+
+def current_scn(conn: DbConnection) -> int:
+    rows = execute_sql_select(
+        conn, "SELECT DBMS_FLASHBACK.GET_SYSTEM_CHANGE_NUMBER AS SCN FROM DUAL"
+    )
+    return rows[0]["SCN"]
+
+
+@contextmanager
+def read_as_of_scn(conn: DbConnection, scn: int):
+    """Makes the session's queries read the database as it was at scn"""
+    with conn.cursor() as cursor:
+        cursor.callproc("DBMS_FLASHBACK.ENABLE_AT_SYSTEM_CHANGE_NUMBER", [scn])
+    try:
+        yield
+    finally:
+        with conn.cursor() as cursor:
+            cursor.callproc("DBMS_FLASHBACK.DISABLE")
+
+
+def apply_watermark(script_data: ScriptData, query: str, query_params: dict) -> str:
+    """Restrict the query to closing days after the watermark of the last
+    successful run.
+
+    The query marks where the restriction goes with {{watermark_predicate}} and the
+    config supplies the predicate, written against the base columns so that it can
+    use the CLOSEDATE index:
+        AND a.CLOSEDATE > TO_DATE(:wm_closedate, 'MM/DD/YYYY')
+        AND a.CLOSEDATE < TO_DATE(:wm_today, 'MM/DD/YYYY')
+    The watermark is a whole closing day. Today's closures are still being posted,
+    so they are left for the next run rather than read half done. :wm_today is
+    today_date(), the same day advance_watermark stops at, rather than SYSDATE,
+    which is in the database server's timezone. This assumes
+    closures are never back-dated to a day that has already ended; one that is
+    will only be picked up by FULL_RESCAN_YN=Y or a backfill.
+
+    Bind variables are only added when the predicate is used. A backfill reads
+    its whole range, like a full rescan, but still advances the watermark.
+    """
+    apwx = script_data.apwx
+    if (
+        not apwx.args.WATERMARK_FILE
+        or apwx.args.FULL_RESCAN_YN.upper() == "Y"
+        or apwx.args.BACKFILL_END_DATE
+    ):
+        return query.replace("{{watermark_predicate}}", "")
+    if "{{watermark_predicate}}" not in query:
+        print("Query has no {{watermark_predicate}} placeholder, doing a full scan")
+        return query
+
+    watermark = read_watermark(apwx.args.WATERMARK_FILE)
+    wm_closedate = watermark["CLOSEDATE"] if watermark else WATERMARK_START
+    print(f"Reading closed accounts past CLOSEDATE {wm_closedate}")
+    query_params["wm_closedate"] = wm_closedate
+    query_params["wm_today"] = today_date()
+    return query.replace(
+        "{{watermark_predicate}}", script_data.config["watermark_predicate"]
+    )
+
+
+def advance_watermark(script_data: ScriptData, accounts: list[dict]):
+    """Move the watermark to the last closing day this run finished. Must only be
+    called once the audit log is written, so a failed run is read again next time.
+
+    Nothing moves when members are not really emailed (SEND_EMAIL_YN=N, a local
+    run or a TEST_EMAIL_ADDR run), so the next real run still sees those
+    accounts. The watermark also stops before the first day with an "Email
+    Failed" account and before today, so those days are read again. The accounts
+    on those days that were already emailed are kept under SENT, by closing day,
+    until the watermark passes their day, and the next run skips them.
+    """
+    watermark_file = script_data.apwx.args.WATERMARK_FILE
+    if not watermark_file:
+        return
+    if (
+        is_local_environment()
+        or not send_email_enabled(script_data)
+        or script_data.apwx.args.TEST_EMAIL_ADDR
+    ):
+        print("Emails were not sent to members, the watermark is not advanced")
+        return
+
+    stop_date = datetime.strptime(today_date(), "%m/%d/%Y")
+    for account in accounts:
+        if account.get("RESULT") == "Email Failed":
+            stop_date = min(stop_date, closing_day(account))
+
+    watermark = read_watermark(watermark_file)
+    old_watermark = watermark or {"CLOSEDATE": WATERMARK_START}
+    closedate = closing_day(old_watermark)
+    sent = {
+        day: list(acctnbrs) for day, acctnbrs in old_watermark.get("SENT", {}).items()
+    }
+    for account in accounts:
+        day = closing_day(account)
+        if day < stop_date:
+            closedate = max(closedate, day)
+        if account.get("RESULT") in ("Email Sent", "Email Already Sent"):
+            day_sent = sent.setdefault(account["CLOSEDATE"], [])
+            if account["ACCTNBR"] not in day_sent:
+                day_sent.append(account["ACCTNBR"])
+
+    new_watermark = {"CLOSEDATE": closedate.strftime("%m/%d/%Y")}
+    sent = {
+        day: acctnbrs
+        for day, acctnbrs in sent.items()
+        if datetime.strptime(day, "%m/%d/%Y") > closedate
+    }
+    if sent:
+        new_watermark["SENT"] = sent
+    if new_watermark != (watermark or {}):
+        write_watermark(watermark_file, new_watermark)
+
+
+def read_sent_accounts(apwx: Apwx) -> set:
+    """ACCTNBRs already emailed on the closing days the watermark holds back"""
+    if not apwx.args.WATERMARK_FILE:
+        return set()
+    watermark = read_watermark(apwx.args.WATERMARK_FILE) or {}
+    return {
+        acctnbr
+        for acctnbrs in watermark.get("SENT", {}).values()
+        for acctnbr in acctnbrs
+    }
+
+
+def closing_day(record: dict) -> datetime:
+    return datetime.strptime(record["CLOSEDATE"], "%m/%d/%Y")
+
+
+def read_watermark(watermark_file: str) -> Optional[dict]:
+    if not os.path.exists(watermark_file):
+        return None
+    with open(watermark_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_watermark(watermark_file: str, watermark: dict):
+    """Replace the watermark file atomically so a crash never leaves it half written"""
+    watermark_dir = os.path.dirname(os.path.abspath(watermark_file))
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=watermark_dir, delete=False
+    ) as f:
+        json.dump(watermark, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, watermark_file)
+    print(
+        f"Watermark at CLOSEDATE {watermark['CLOSEDATE']}, holding back "
+        f"{len(watermark.get('SENT', {}))} days with accounts already emailed"
+    )
+
+
+def audit_log_file_name(apwx: Apwx, effdate: str) -> str:
+    """OUTPUT_FILE_NAME, suffixed with the EFFDATE when backfilling so that each
+    date gets its own audit log, e.g. output_07232025.csv"""
+    if not apwx.args.BACKFILL_END_DATE:
+        return apwx.args.OUTPUT_FILE_NAME
+    output_file_name = Path(apwx.args.OUTPUT_FILE_NAME)
+    effdate_suffix = parse_effdate(effdate).strftime("%m%d%Y")
+    return f"{output_file_name.stem}_{effdate_suffix}{output_file_name.suffix}"
+
+
 def today_date() -> str:
     los_angeles_tz = ZoneInfo("America/Los_Angeles")
     today = datetime.now(los_angeles_tz).date()
@@ -252,11 +922,45 @@ def is_fdi(account: dict) -> bool:
     return fdi_inactive_date >= datetime.now()
 
 
+def recipient_address(script_data: ScriptData, account: dict) -> str:
+    """The address the email actually goes to, which is the test address if set"""
+    test_email_addr = script_data.apwx.args.TEST_EMAIL_ADDR
+    return test_email_addr if test_email_addr else account.get("EMAILADDR")
+
+
+def recipient_domain(script_data: ScriptData, account: dict) -> str:
+    return recipient_address(script_data, account).rpartition("@")[2].lower()
+
+
+def get_delivery_scheduler(script_data: ScriptData) -> DeliveryScheduler:
+    """Builds the scheduler from the SMTP arguments. Limits for specific domains
+    can be set in the config, e.g. domain_limits: {gmail.com: {concurrency: 2}}"""
+    apwx = script_data.apwx
+    try:
+        default_limit = DomainLimit(
+            concurrency=int(apwx.args.SMTP_DOMAIN_CONCURRENCY),
+            rate=float(apwx.args.SMTP_DOMAIN_RATE),
+        )
+    except ValueError as e:
+        raise ValueError(f"SMTP_DOMAIN_CONCURRENCY / SMTP_DOMAIN_RATE: {e}")
+
+    domain_limits = {}
+    for domain, limits in (script_data.config.get("domain_limits") or {}).items():
+        try:
+            domain_limits[domain.lower()] = DomainLimit(
+                concurrency=limits.get("concurrency", default_limit.concurrency),
+                rate=limits.get("rate", default_limit.rate),
+            )
+        except ValueError as e:
+            raise ValueError(f"domain_limits for {domain}: {e}")
+    return DeliveryScheduler(
+        int(apwx.args.SMTP_MAX_CONNECTIONS), default_limit, domain_limits
+    )
+
+
 def send_email(script_data: ScriptData, account: dict) -> (bool, str):
     apwx = script_data.apwx
-    to_address = account.get("EMAILADDR")
-    if apwx.args.TEST_EMAIL_ADDR:
-        to_address = apwx.args.TEST_EMAIL_ADDR
+    to_address = recipient_address(script_data, account)
     from_address = apwx.args.FROM_EMAIL_ADDR
 
     # Create the email body
@@ -303,23 +1007,89 @@ def send_smtp_request(
     to_address: str,
     email_message: EmailMessage,
 ):
-    """Send email request to SMTP server"""
+    """Send email request to SMTP server over one of the run's open sessions"""
+    smtp_sessions = script_data.smtp_sessions
+
+    def connect() -> ResumableSMTP:
+        return open_smtp_session(script_data)
+
+    server = smtp_sessions.acquire(connect)
+    try:
+        print(f"Sending email...")
+        try:
+            server.sendmail(from_address, to_address, email_message.as_string())
+        except smtplib.SMTPException as e:
+            if not smtp_session_lost(server, e):
+                raise
+            # The relay closed a session that sat idle or hit its message limit
+            print("SMTP session was closed by the server, reconnecting")
+            server.close()
+            server = smtp_sessions.open(connect)
+            server.sendmail(from_address, to_address, email_message.as_string())
+    except smtplib.SMTPException as e:
+        if smtp_session_lost(server, e):
+            server.close()
+        else:
+            # The server refused this message, the session itself is still usable
+            smtp_sessions.release(server)
+        raise
+    except Exception:
+        server.close()
+        raise
+    smtp_sessions.release(server)
+
+
+def smtp_session_lost(server: ResumableSMTP, error: smtplib.SMTPException) -> bool:
+    """Whether the relay ended the session, either by dropping the connection or
+    by answering 421, after which smtplib has already closed the socket"""
+    if isinstance(error, smtplib.SMTPServerDisconnected) or server.sock is None:
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code == 421 for code, _ in error.recipients.values())
+    return False
+
+
+def open_smtp_session(script_data: ScriptData) -> ResumableSMTP:
+    """Connects, upgrades to TLS (resuming an earlier TLS session if there is one)
+    and logs in"""
     apwx = script_data.apwx
     smtp_server = apwx.args.SMTP_SERVER
     smtp_port = int(apwx.args.SMTP_PORT)
     smtp_user = apwx.args.SMTP_USER
     smtp_password = apwx.args.SMTP_PASSWORD
 
-    with smtplib.SMTP(smtp_server, smtp_port) as server:
-        print(f"Connecting to SMTP server {smtp_server}:{smtp_port}")
-        server.connect(smtp_server, smtp_port)
+    tls_sessions = script_data.tls_sessions
+
+    print(f"Connecting to SMTP server {smtp_server}:{smtp_port}")
+    server = ResumableSMTP(smtp_server, smtp_port)
+    try:
         server.ehlo()
-        server.starttls()
+        server.starttls(
+            context=script_data.ssl_context,
+            session=tls_sessions.get(smtp_server, smtp_port),
+        )
         server.ehlo()
+        tls_sessions.record(smtp_server, smtp_port, server.sock)
         print(f"Logging into {smtp_server} as {smtp_user}")
         server.login(smtp_user, smtp_password)
-        print(f"Sending email...")
-        server.sendmail(from_address, to_address, email_message.as_string())
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def print_tls_stats(script_data: ScriptData):
+    """Report how many SMTP sessions were opened and how many of their TLS
+    handshakes were abbreviated by session resumption"""
+    tls_sessions = script_data.tls_sessions
+    print(
+        f"SMTP sessions opened: {script_data.smtp_sessions.sessions_opened}, "
+        f"TLS handshakes: {tls_sessions.handshakes}, "
+        f"resumed: {tls_sessions.resumed} "
+        f"({tls_sessions.hit_rate():.1%} resumption hit rate)"
+    )
 
 
 def format_minor_codes(minor_codes_str: str) -> str:
@@ -340,11 +1110,58 @@ def send_email_enabled(script_data: ScriptData) -> bool:
     return script_data.apwx.args.SEND_EMAIL_YN.upper() == "Y"
 
 
+def memory_profile_enabled(apwx: Apwx) -> bool:
+    return apwx.args.MEMORY_PROFILE_YN.upper() == "Y"
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the process. Linux reports ru_maxrss in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def dna_db_connect(apwx):
     """Creates a connection to DNA database"""
     return apwx.db_connect(autocommit=False)
 
 
+def get_ssl_context(apwx: Apwx) -> ssl.SSLContext:
+    """Creates the SSL context shared by every SMTP connection of the run"""
+    # Without a CA file the system trust store is used
+    context = ssl.create_default_context(cafile=apwx.args.SMTP_TLS_CA_FILE or None)
+    if apwx.args.SMTP_TLS_VERIFY_YN.upper() == "N":
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def partitioned_fetch_enabled(apwx: Apwx, config: Any) -> bool:
+    """Whether the query runs as DB_FETCH_PARTITIONS slices rather than a single
+    cursor. Raises ValueError when the query asks for slices but the config does
+    not say how to make and merge them"""
+    if int(apwx.args.DB_FETCH_PARTITIONS) <= 1:
+        return False
+    if "{{partition_predicate}}" not in config["get_closed_accounts"]:
+        print("Query has no {{partition_predicate}} placeholder, fetching serially")
+        return False
+    missing = [
+        key
+        for key in ("partition_predicate", "partition_merge_keys")
+        if not config.get(key)
+    ]
+    if missing:
+        raise ValueError(
+            f"DB_FETCH_PARTITIONS={apwx.args.DB_FETCH_PARTITIONS} needs "
+            f"{' and '.join(missing)} in the config"
+        )
+    return True
+
+
+def dna_db_pool(apwx: Apwx) -> DbSessionPool:
+    """Opens one extra session per partition for partitioned fetches"""
+    partition_count = int(apwx.args.DB_FETCH_PARTITIONS)
+    return DbSessionPool([dna_db_connect(apwx) for _ in range(partition_count)])
+
+
 def get_config(apwx: Apwx) -> Any:
     """Loads the config YAML file"""
     with open(apwx.args.CONFIG_FILE_PATH, "r") as f:
@@ -1,12 +1,20 @@
 import os
 import pathlib
 import pytest
+import shutil
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
 
 from dataclasses import dataclass
+from typing import Optional
 from ..cns_closed_accts_email import (
     AppWorxEnum,
     get_config,
     get_email_template,
+    get_ssl_context,
     ScriptData,
 )
 
@@ -16,9 +24,13 @@ class FakeApwxArgs:
     """Arguments for the fake Apwx"""
 
     TNS_SERVICE_NAME: str
+    BACKFILL_END_DATE: str
     CONFIG_FILE_PATH: str
+    DB_FETCH_PARTITIONS: str
     EFFDATE: str
     FROM_EMAIL_ADDR: str
+    FULL_RESCAN_YN: str
+    MEMORY_PROFILE_YN: str
     MINOR_CODES: str
     OUTPUT_FILE_PATH: str
     OUTPUT_FILE_NAME: str
@@ -27,7 +39,13 @@ class FakeApwxArgs:
     SMTP_PORT: str
     SMTP_USER: str
     SMTP_PASSWORD: str
+    SMTP_MAX_CONNECTIONS: str
+    SMTP_DOMAIN_CONCURRENCY: str
+    SMTP_DOMAIN_RATE: str
+    SMTP_TLS_CA_FILE: str
+    SMTP_TLS_VERIFY_YN: str
     TEST_EMAIL_ADDR: str
+    WATERMARK_FILE: str
 
 
 @dataclass
@@ -44,9 +62,13 @@ TEST_BASE_PATH = pathlib.Path(os.path.dirname(_file_))
 # with different behaviors
 SCRIPT_ARGUMENTS = {
     str(AppWorxEnum.TNS_SERVICE_NAME): "NON_EXISTING_DB",
+    str(AppWorxEnum.BACKFILL_END_DATE): None,
     str(AppWorxEnum.CONFIG_FILE_PATH): TEST_BASE_PATH.parent / "config" / "config.yaml",
+    str(AppWorxEnum.DB_FETCH_PARTITIONS): "1",
     str(AppWorxEnum.EFFDATE): "07/23/2025",
     str(AppWorxEnum.FROM_EMAIL_ADDR): "member.communications@firsttechfed.com",
+    str(AppWorxEnum.FULL_RESCAN_YN): "N",
+    str(AppWorxEnum.MEMORY_PROFILE_YN): "N",
     str(AppWorxEnum.MINOR_CODES): "NACL,NAIL,UAOE,UACL,INRV,INAU,INUA,OVCL,OVOE,UAIL",
     str(AppWorxEnum.OUTPUT_FILE_PATH): TEST_BASE_PATH,
     str(AppWorxEnum.OUTPUT_FILE_NAME): "output.csv",
@@ -55,14 +77,24 @@ SCRIPT_ARGUMENTS = {
     str(AppWorxEnum.SMTP_PORT): "587",
     str(AppWorxEnum.SMTP_USER): "smtp-user",
     str(AppWorxEnum.SMTP_PASSWORD): "smtp-password",
+    str(AppWorxEnum.SMTP_MAX_CONNECTIONS): "1",
+    str(AppWorxEnum.SMTP_DOMAIN_CONCURRENCY): "1",
+    str(AppWorxEnum.SMTP_DOMAIN_RATE): "0",
+    str(AppWorxEnum.SMTP_TLS_CA_FILE): None,
+    str(AppWorxEnum.SMTP_TLS_VERIFY_YN): "Y",
     str(AppWorxEnum.TEST_EMAIL_ADDR): "test_closed_accts_email@firsttechfed.com",
+    str(AppWorxEnum.WATERMARK_FILE): None,
 }
 
 SCRIPT_ARGUMENTS_SEND_EMAIL_N = {
     str(AppWorxEnum.TNS_SERVICE_NAME): "NON_EXISTING_DB",
+    str(AppWorxEnum.BACKFILL_END_DATE): None,
     str(AppWorxEnum.CONFIG_FILE_PATH): TEST_BASE_PATH.parent / "config" / "config.yaml",
+    str(AppWorxEnum.DB_FETCH_PARTITIONS): "1",
     str(AppWorxEnum.EFFDATE): "07/23/2025",
     str(AppWorxEnum.FROM_EMAIL_ADDR): "member.communications@firsttechfed.com",
+    str(AppWorxEnum.FULL_RESCAN_YN): "N",
+    str(AppWorxEnum.MEMORY_PROFILE_YN): "N",
     str(AppWorxEnum.MINOR_CODES): "NACL,NAIL,UAOE,UACL,INRV,INAU,INUA,OVCL,OVOE,UAIL",
     str(AppWorxEnum.OUTPUT_FILE_PATH): TEST_BASE_PATH,
     str(AppWorxEnum.OUTPUT_FILE_NAME): "output_send_email_n.csv",
@@ -71,7 +103,13 @@ SCRIPT_ARGUMENTS_SEND_EMAIL_N = {
     str(AppWorxEnum.SMTP_PORT): "587",
     str(AppWorxEnum.SMTP_USER): "smtp-user",
     str(AppWorxEnum.SMTP_PASSWORD): "smtp-password",
+    str(AppWorxEnum.SMTP_MAX_CONNECTIONS): "1",
+    str(AppWorxEnum.SMTP_DOMAIN_CONCURRENCY): "1",
+    str(AppWorxEnum.SMTP_DOMAIN_RATE): "0",
+    str(AppWorxEnum.SMTP_TLS_CA_FILE): None,
+    str(AppWorxEnum.SMTP_TLS_VERIFY_YN): "Y",
     str(AppWorxEnum.TEST_EMAIL_ADDR): "test_closed_accts_email@firsttechfed.com",
+    str(AppWorxEnum.WATERMARK_FILE): None,
 }
 
 
@@ -80,9 +118,13 @@ def new_fake_apwx(script_args: dict) -> FakeApwx:
     return FakeApwx(
         args=FakeApwxArgs(
             TNS_SERVICE_NAME=script_args[str(AppWorxEnum.TNS_SERVICE_NAME)],
+            BACKFILL_END_DATE=script_args[str(AppWorxEnum.BACKFILL_END_DATE)],
             CONFIG_FILE_PATH=script_args[str(AppWorxEnum.CONFIG_FILE_PATH)],
+            DB_FETCH_PARTITIONS=script_args[str(AppWorxEnum.DB_FETCH_PARTITIONS)],
             EFFDATE=script_args[str(AppWorxEnum.EFFDATE)],
             FROM_EMAIL_ADDR=script_args[str(AppWorxEnum.FROM_EMAIL_ADDR)],
+            FULL_RESCAN_YN=script_args[str(AppWorxEnum.FULL_RESCAN_YN)],
+            MEMORY_PROFILE_YN=script_args[str(AppWorxEnum.MEMORY_PROFILE_YN)],
             MINOR_CODES=script_args[str(AppWorxEnum.MINOR_CODES)],
             OUTPUT_FILE_PATH=script_args[str(AppWorxEnum.OUTPUT_FILE_PATH)],
             OUTPUT_FILE_NAME=script_args[str(AppWorxEnum.OUTPUT_FILE_NAME)],
@@ -91,7 +133,15 @@ def new_fake_apwx(script_args: dict) -> FakeApwx:
             SMTP_PORT=script_args[str(AppWorxEnum.SMTP_PORT)],
             SMTP_USER=script_args[str(AppWorxEnum.SMTP_USER)],
             SMTP_PASSWORD=script_args[str(AppWorxEnum.SMTP_PASSWORD)],
+            SMTP_MAX_CONNECTIONS=script_args[str(AppWorxEnum.SMTP_MAX_CONNECTIONS)],
+            SMTP_DOMAIN_CONCURRENCY=script_args[
+                str(AppWorxEnum.SMTP_DOMAIN_CONCURRENCY)
+            ],
+            SMTP_DOMAIN_RATE=script_args[str(AppWorxEnum.SMTP_DOMAIN_RATE)],
+            SMTP_TLS_CA_FILE=script_args[str(AppWorxEnum.SMTP_TLS_CA_FILE)],
+            SMTP_TLS_VERIFY_YN=script_args[str(AppWorxEnum.SMTP_TLS_VERIFY_YN)],
             TEST_EMAIL_ADDR=script_args[str(AppWorxEnum.TEST_EMAIL_ADDR)],
+            WATERMARK_FILE=script_args[str(AppWorxEnum.WATERMARK_FILE)],
         )
     )
 
@@ -105,6 +155,7 @@ def script_data():
         dbh=None,
         config=config,
         email_template=get_email_template(config),
+        ssl_context=get_ssl_context(appworx),
     )
 
 
@@ -117,4 +168,300 @@ def script_data_send_email_n():
         dbh=None,
         config=config,
         email_template=get_email_template(config),
+        ssl_context=get_ssl_context(appworx),
+    )
+
+
+class StandInSmtpHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough ESMTP (STARTTLS, AUTH PLAIN, MAIL/RCPT/DATA) to stand
+    in for the relay"""
+
+    def handle(self):
+        self.domain = None
+        self.server.record_session()
+        try:
+            self._converse()
+        finally:
+            self._release_domain()
+
+    def _release_domain(self):
+        if self.domain:
+            self.server.release_domain(self.domain)
+            self.domain = None
+
+    def _converse(self):
+        self._reply("220 stand-in ESMTP")
+        tls_sock = None
+        messages = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode().strip().split(" ", 1)[0].upper()
+            if (
+                messages
+                and messages == self.server.max_messages_per_session
+                and verb == self.server.session_limit_verb
+            ):
+                self._reply("421 4.4.2 Session limit reached, closing connection")
+                return
+            if verb == "EHLO":
+                extension = "250 AUTH PLAIN" if tls_sock else "250 STARTTLS"
+                self._reply("250-stand-in", extension)
+            elif verb == "STARTTLS":
+                self._reply("220 Ready to start TLS")
+                tls_sock = self.server.tls_context.wrap_socket(
+                    self.connection, server_side=True
+                )
+                self.rfile = tls_sock.makefile("rb")
+                self.wfile = tls_sock.makefile("wb")
+                self.server.record_handshake(tls_sock)
+            elif verb == "AUTH":
+                self.server.record_login()
+                self._reply("235 Authentication successful")
+            elif verb == "RCPT":
+                domain = line.decode().strip().rstrip(">").rpartition("@")[2]
+                if self.server.accept_domain(domain):
+                    self.domain = domain
+                    self._reply("250 OK")
+                else:
+                    self._reply("451 4.7.1 Too much mail for this domain, try later")
+            elif verb == "RSET":
+                self._release_domain()
+                self._reply("250 OK")
+            elif verb in ("MAIL", "NOOP"):
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.server.record_delivery(self.domain)
+                self._release_domain()
+                self._reply("250 OK")
+                messages += 1
+                if (
+                    messages == self.server.max_messages_per_session
+                    and self.server.session_limit_verb is None
+                ):
+                    # Relays drop sessions after a number of messages
+                    return
+            elif verb == "QUIT":
+                # The client may reconnect as soon as it reads the reply
+                self._release_domain()
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+    def _reply(self, *lines: str):
+        self.wfile.write("".join(f"{line}\r\n" for line in lines).encode())
+        self.wfile.flush()
+
+
+class StandInSmtpServer(socketserver.ThreadingTCPServer):
+    """Local SMTP relay used to exercise the real smtplib code path. Like large
+    mailbox providers it defers recipients of a domain that has too many messages
+    in progress or had a message accepted less than domain_interval seconds ago.
+    Like most relays it closes a session after max_messages_per_session, either
+    silently or, when session_limit_verb is set, by answering that command of the
+    next message with 421"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        tls_context: ssl.SSLContext,
+        domain_concurrency: int = 0,
+        domain_interval: float = 0.0,
+        max_messages_per_session: int = 0,
+        session_limit_verb: Optional[str] = None,
+    ):
+        super().__init__(("localhost", 0), StandInSmtpHandler)
+        self.tls_context = tls_context
+        self.domain_concurrency = domain_concurrency
+        self.domain_interval = domain_interval
+        self.max_messages_per_session = max_messages_per_session
+        self.session_limit_verb = session_limit_verb
+        self.sessions = 0
+        self.logins = 0
+        self.lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed_handshakes = 0
+        self.accepted: list[str] = []
+        self.deferred: list[str] = []
+        self.delivered: list[str] = []
+        self.open_sessions: dict[str, int] = {}
+        self.last_accepted_at: dict[str, float] = {}
+
+    def accept_domain(self, domain: str) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            open_sessions = self.open_sessions.get(domain, 0)
+            last_accepted_at = self.last_accepted_at.get(domain)
+            if (
+                self.domain_concurrency and open_sessions >= self.domain_concurrency
+            ) or (
+                last_accepted_at is not None
+                and now - last_accepted_at < self.domain_interval
+            ):
+                self.deferred.append(domain)
+                return False
+            self.open_sessions[domain] = open_sessions + 1
+            self.last_accepted_at[domain] = now
+            self.accepted.append(domain)
+            return True
+
+    def record_session(self):
+        with self.lock:
+            self.sessions += 1
+
+    def record_delivery(self, domain: str):
+        with self.lock:
+            self.delivered.append(domain)
+
+    def record_login(self):
+        with self.lock:
+            self.logins += 1
+
+    def release_domain(self, domain: str):
+        with self.lock:
+            self.open_sessions[domain] -= 1
+
+    def record_handshake(self, tls_sock: ssl.SSLSocket):
+        with self.lock:
+            self.handshakes += 1
+            if tls_sock.session_reused:
+                self.resumed_handshakes += 1
+
+
+@pytest.fixture(scope="module")
+def tls_certificate(tmp_path_factory):
+    """Self-signed certificate for localhost, returned as (cert, key) paths"""
+    if not shutil.which("openssl"):
+        pytest.skip("openssl is required to generate a test certificate")
+    cert_dir = tmp_path_factory.mktemp("tls")
+    cert_file, key_file = cert_dir / "cert.pem", cert_dir / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-keyout", str(key_file), "-out", str(cert_file)]
+        + ["-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost"],
+        check=True,
+        capture_output=True,
+    )
+    return cert_file, key_file
+
+
+@pytest.fixture
+def smtp_server(tls_certificate):
+    cert_file, key_file = tls_certificate
+    tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    tls_context.load_cert_chain(cert_file, key_file)
+    server = StandInSmtpServer(tls_context)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def script_data_smtp(smtp_server, tls_certificate):
+    """Script data pointing at the stand-in SMTP server and trusting its certificate"""
+    appworx = new_fake_apwx(
+        {
+            **SCRIPT_ARGUMENTS,
+            str(AppWorxEnum.SMTP_SERVER): "localhost",
+            str(AppWorxEnum.SMTP_PORT): str(smtp_server.server_address[1]),
+            str(AppWorxEnum.SMTP_TLS_CA_FILE): str(tls_certificate[0]),
+        }
+    )
+    config = get_config(appworx)
+    return ScriptData(
+        apwx=appworx,
+        dbh=None,
+        config=config,
+        email_template=get_email_template(config),
+        ssl_context=get_ssl_context(appworx),
+    )
+
+
+@pytest.fixture
+def script_data_watermark(tmp_path):
+    """Script data with a watermark file and a query that accepts the predicate"""
+    appworx = new_fake_apwx(
+        {
+            **SCRIPT_ARGUMENTS,
+            str(AppWorxEnum.TEST_EMAIL_ADDR): None,
+            str(AppWorxEnum.WATERMARK_FILE): str(tmp_path / "watermark.json"),
+        }
+    )
+    config = {
+        **get_config(appworx),
+        "get_closed_accounts": (
+            "SELECT * FROM ACCT a WHERE a.CLOSEDATE >= :effdate "
+            "AND a.MINOR IN ({{minor_codes}}) {{watermark_predicate}}"
+        ),
+        "watermark_predicate": (
+            "AND a.CLOSEDATE > TO_DATE(:wm_closedate, 'MM/DD/YYYY') "
+            "AND a.CLOSEDATE < TO_DATE(:wm_today, 'MM/DD/YYYY')"
+        ),
+    }
+    return ScriptData(
+        apwx=appworx,
+        dbh=None,
+        config=config,
+        email_template=get_email_template(config),
+        ssl_context=get_ssl_context(appworx),
+    )
+
+
+@pytest.fixture
+def script_data_partitioned(mocker):
+    """Script data that fetches in three partitions from a fake session pool"""
+    appworx = new_fake_apwx(
+        {**SCRIPT_ARGUMENTS, str(AppWorxEnum.DB_FETCH_PARTITIONS): "3"}
+    )
+    config = {
+        **get_config(appworx),
+        # CLOSEDATE comes back as MM/DD/YYYY text, so the merge orders on the raw
+        # DATE selected as CLOSEDATE_SORT
+        "get_closed_accounts": (
+            "SELECT a.*, a.CLOSEDATE AS CLOSEDATE_SORT FROM ACCT a "
+            "WHERE a.CLOSEDATE >= :effdate "
+            "AND a.MINOR IN ({{minor_codes}}) {{partition_predicate}} "
+            "ORDER BY a.CLOSEDATE, a.ACCTNBR"
+        ),
+        "partition_predicate": (
+            "AND MOD(a.ACCTNBR, :partition_count) = :partition_index"
+        ),
+        "partition_merge_keys": ["CLOSEDATE_SORT", "ACCTNBR"],
+    }
+    return ScriptData(
+        apwx=appworx,
+        dbh=None,
+        config=config,
+        email_template=get_email_template(config),
+        ssl_context=get_ssl_context(appworx),
+        db_pool=mocker.MagicMock(),
+    )
+
+
+@pytest.fixture
+def script_data_backfill(tmp_path):
+    """Script data for a three day backfill writing its audit logs to tmp_path"""
+    appworx = new_fake_apwx(
+        {
+            **SCRIPT_ARGUMENTS,
+            str(AppWorxEnum.EFFDATE): "07/21/2025",
+            str(AppWorxEnum.BACKFILL_END_DATE): "07-23-2025",
+            str(AppWorxEnum.OUTPUT_FILE_PATH): tmp_path,
+        }
+    )
+    config = get_config(appworx)
+    return ScriptData(
+        apwx=appworx,
+        dbh=None,
+        config=config,
+        email_template=get_email_template(config),
+        ssl_context=get_ssl_context(appworx),
     )
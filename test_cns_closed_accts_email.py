@@ -1,14 +1,37 @@
 import csv
 import os
+import pytest
+import smtplib
+import ssl
+import threading
+import time
+import tracemalloc
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 from ..cns_closed_accts_email import (
+    advance_watermark,
+    close_connections,
+    DeliveryScheduler,
+    DomainLimit,
     format_minor_codes,
+    generate_email_message,
     get_closed_accounts,
+    get_delivery_scheduler,
+    get_effdates,
+    get_ssl_context,
+    initialize,
     is_fdi,
+    MemoryProfiler,
+    process_records,
+    read_watermark,
     run,
     send_email_enabled,
+    send_smtp_request,
     validate_email,
+    WATERMARK_START,
+    write_audit_log,
 )
 
 # Get the module name since it is dynamically generated in CICD env
@@ -178,6 +201,210 @@ def test_run(script_data, mocker):
     _validate_report_file(script_data)
 
 
+def _synthetic_accounts(
+    count: int, partition_count: int = 1, partition_index: int = 0
+) -> list[dict]:
+    """Builds rows shaped like the closed accounts query output, or the slice of
+    them a partitioned fetch would return"""
+    template = {
+        **EXPECTED_CLOSED_ACCOUNTS[1],
+        "CLOSEDATE_SORT": datetime(2025, 7, 14),
+    }
+    return [
+        {
+            **template,
+            "ACCTNBR": 9300000000 + i,
+            "PERSNBR": 3000000 + i,
+            "MEMBERNAME": f"Member Tester{i}",
+            "EMAILADDR": f"member_tester{i}@gmail.com",
+        }
+        for i in range(partition_index, count, partition_count)
+    ]
+
+
+# Regression gates for the peak memory a run adds per account on top of the
+# fetched rows themselves (~680 bytes). Fetching adds nothing to a single query
+# and one pointer per account for the merged list of a partitioned fetch, so an
+# extra copy of the account list fails the fetch gate. Processing and the audit
+# log add ~70 bytes. Raise these only with a justification in the commit message.
+MAX_FETCH_BYTES_PER_ACCOUNT = {
+    "script_data_send_email_n": 4,
+    "script_data_partitioned": 14,
+}
+MAX_BYTES_PER_ACCOUNT = 128
+
+
+def _row_bytes_per_account(account_count: int) -> float:
+    """Traced size of the fetched rows alone, per account"""
+    tracemalloc.start()
+    try:
+        rows = _synthetic_accounts(account_count)
+        return tracemalloc.get_traced_memory()[0] / len(rows)
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize("script_data_fixture", list(MAX_FETCH_BYTES_PER_ACCOUNT))
+def test_memory_per_account(script_data_fixture, request, mocker):
+    script_data = request.getfixturevalue(script_data_fixture)
+    account_count = 100_000
+    row_bytes = _row_bytes_per_account(account_count)
+    # Validation and message rendering allocate nothing that outlives the account
+    # but take minutes at this size under tracemalloc. Plain functions are used
+    # instead of mocks because mocks keep a record of every call.
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.validate_email",
+        new=lambda email: True,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.send_email",
+        new=lambda script_data, account: (True, "Email Sent"),
+    )
+    # The rows are generated by the fetch, inside the traced region, so copies
+    # made while fetching and merging partitions are measured too
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.current_scn",
+        new=lambda conn: 1234567,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.execute_sql_select",
+        new=lambda conn, query, query_params: _synthetic_accounts(
+            account_count,
+            query_params.get("partition_count", 1),
+            query_params.get("partition_index", 0),
+        ),
+    )
+    profiler = MemoryProfiler(enabled=True, top_n=0)
+    accounts = get_closed_accounts(script_data)
+    profiler.checkpoint("get_closed_accounts")
+    process_records(script_data, accounts)
+    profiler.checkpoint("process_records")
+    write_audit_log(script_data, accounts)
+    profiler.checkpoint("write_audit_log")
+    bytes_per_account = profiler.report(len(accounts))
+
+    assert len(accounts) == account_count
+    fetch_bytes = profiler.stage_peak_bytes["get_closed_accounts"] / account_count
+    assert fetch_bytes - row_bytes < MAX_FETCH_BYTES_PER_ACCOUNT[script_data_fixture]
+    assert bytes_per_account - row_bytes < MAX_BYTES_PER_ACCOUNT
+
+
+def test_run_stops_memory_profiler_on_failure(script_data, mocker):
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.memory_profile_enabled",
+        return_value=True,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.initialize",
+        side_effect=Exception("SQL error = ORA-12154"),
+    )
+    with pytest.raises(Exception, match="ORA-12154"):
+        run(script_data.apwx)
+    assert tracemalloc.is_tracing() is False
+
+
+def test_memory_profiler_disabled():
+    profiler = MemoryProfiler(enabled=False)
+    profiler.checkpoint("initialize")
+    assert profiler.report(100) == 0.0
+
+
+def test_delivery_scheduler_round_robin():
+    items = ["1@a.com", "2@a.com", "3@a.com", "4@a.com", "5@b.com", "6@b.com"]
+    items.append("7@c.com")
+    sent = []
+    scheduler = DeliveryScheduler(max_workers=1, default_limit=DomainLimit())
+    scheduler.run(items, lambda item: item.split("@")[1], sent.append)
+    assert sent == ["1@a.com", "5@b.com", "7@c.com", "2@a.com", "6@b.com"] + [
+        "3@a.com",
+        "4@a.com",
+    ]
+
+
+def test_delivery_scheduler_limits(mocker):
+    lock = threading.Lock()
+    in_flight = {"a.com": 0, "b.com": 0}
+    max_in_flight = {"a.com": 0, "b.com": 0}
+    dispatched_at = {"a.com": [], "b.com": []}
+
+    # Rate limits apply to when the scheduler dispatches, not to when the worker
+    # thread gets to run, so record the dispatch time
+    submit = ThreadPoolExecutor.submit
+
+    def timed_submit(executor, fn, domain, item):
+        dispatched_at[domain].append(time.monotonic())
+        return submit(executor, fn, domain, item)
+
+    mocker.patch.object(ThreadPoolExecutor, "submit", timed_submit)
+
+    def send(domain):
+        with lock:
+            in_flight[domain] += 1
+            max_in_flight[domain] = max(max_in_flight[domain], in_flight[domain])
+        time.sleep(0.01)
+        with lock:
+            in_flight[domain] -= 1
+
+    scheduler = DeliveryScheduler(
+        max_workers=4,
+        default_limit=DomainLimit(concurrency=2),
+        domain_limits={"b.com": DomainLimit(concurrency=1, rate=50)},
+    )
+    scheduler.run(["a.com"] * 10 + ["b.com"] * 5, lambda domain: domain, send)
+
+    assert max_in_flight == {"a.com": 2, "b.com": 1}
+    b_dispatched_at = dispatched_at["b.com"]
+    assert len(b_dispatched_at) == 5
+    assert all(
+        later - earlier >= 0.015
+        for earlier, later in zip(b_dispatched_at, b_dispatched_at[1:])
+    )
+
+
+def test_delivery_scheduler_rejects_invalid_limits(script_data):
+    with pytest.raises(ValueError, match="concurrency must be at least 1"):
+        DomainLimit(concurrency=0)
+    with pytest.raises(ValueError, match="rate must not be negative"):
+        DomainLimit(rate=-1)
+    with pytest.raises(ValueError, match="SMTP_MAX_CONNECTIONS"):
+        DeliveryScheduler(max_workers=0, default_limit=DomainLimit())
+
+    config = script_data.config
+    script_data.config = {**config, "domain_limits": {"gmail.com": {"concurrency": 0}}}
+    try:
+        with pytest.raises(ValueError, match="domain_limits for gmail.com"):
+            get_delivery_scheduler(script_data)
+    finally:
+        script_data.config = config
+
+
+def test_process_records_domain_throttling(script_data_smtp, smtp_server, mocker):
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+    # The stand-in defers a domain with more than one open session or more than
+    # 20 messages per second. The job is configured to stay well under that.
+    smtp_server.domain_concurrency = 1
+    smtp_server.domain_interval = 0.05
+    args = script_data_smtp.apwx.args
+    args.TEST_EMAIL_ADDR = None
+    args.SMTP_MAX_CONNECTIONS = "4"
+    args.SMTP_DOMAIN_CONCURRENCY = "1"
+    args.SMTP_DOMAIN_RATE = "5"
+
+    domains = ["gmail.com"] * 6 + ["yahoo.com"] * 3 + ["outlook.com"] * 3
+    accounts = [
+        {**EXPECTED_CLOSED_ACCOUNTS[1], "EMAILADDR": f"member{i}@{domain}"}
+        for i, domain in enumerate(domains)
+    ]
+    process_records(script_data_smtp, accounts)
+
+    assert [account["RESULT"] for account in accounts] == ["Email Sent"] * 12
+    assert smtp_server.deferred == []
+    assert sorted(smtp_server.accepted) == sorted(domains)
+
+
 def _validate_report_file(script_data):
     """Helper function to validate actual CSV output file"""
     apwx = script_data.apwx
@@ -216,6 +443,99 @@ def _validate_report_file(script_data):
         assert next(csv_reader) == ["END"]
 
 
+def test_run_backfill(script_data_backfill, mocker):
+    # Each day repeats the last two accounts of the day before
+    accounts_by_effdate = {
+        "07/21/2025": EXPECTED_CLOSED_ACCOUNTS[0:3],
+        "07/22/2025": EXPECTED_CLOSED_ACCOUNTS[1:5],
+        "07/23/2025": EXPECTED_CLOSED_ACCOUNTS[3:8],
+    }
+    mock_initialize = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.initialize",
+        return_value=script_data_backfill,
+    )
+    mock_get_closed_accounts = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.get_closed_accounts",
+        side_effect=lambda script_data, effdate: [
+            dict(account) for account in accounts_by_effdate[effdate]
+        ],
+    )
+    mock_send_email = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.send_smtp_request",
+        return_value=None,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+
+    assert run(script_data_backfill.apwx) is True
+
+    mock_initialize.assert_called_once()
+    # Each day is queried on its own, over the one shared connection
+    assert [c.args[1] for c in mock_get_closed_accounts.call_args_list] == [
+        "07/21/2025",
+        "07/22/2025",
+        "07/23/2025",
+    ]
+    # The 5 valid addresses are emailed once across the whole backfill
+    assert mock_send_email.call_count == 5
+
+    output_path = Path(script_data_backfill.apwx.args.OUTPUT_FILE_PATH)
+    for effdate, file_name in [
+        ("07/21/2025", "output_07212025.csv"),
+        ("07/22/2025", "output_07222025.csv"),
+        ("07/23/2025", "output_07232025.csv"),
+    ]:
+        with open(output_path / file_name, "r", encoding="utf-8", newline="") as f:
+            rows = list(csv.reader(f))
+        assert rows[2] == [f"EFFDATE: {effdate}"]
+        if effdate == "07/22/2025":
+            assert rows.count(["EXCEPTIONS"]) == 1
+            assert sum("Email Already Sent" in row for row in rows) == 2
+
+
+def test_run_backfill_shares_smtp_sessions(
+    script_data_backfill, smtp_server, tls_certificate, mocker
+):
+    args = script_data_backfill.apwx.args
+    args.SMTP_SERVER = "localhost"
+    args.SMTP_PORT = str(smtp_server.server_address[1])
+    args.SMTP_TLS_CA_FILE = str(tls_certificate[0])
+    args.SMTP_MAX_CONNECTIONS = "2"
+    script_data_backfill.ssl_context = get_ssl_context(script_data_backfill.apwx)
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.initialize",
+        return_value=script_data_backfill,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.get_closed_accounts",
+        side_effect=lambda script_data, effdate: [
+            dict(account) for account in EXPECTED_CLOSED_ACCOUNTS
+        ],
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+
+    assert run(script_data_backfill.apwx) is True
+
+    # Every message goes out, but the whole backfill logs in at most once per worker
+    assert len(smtp_server.accepted) == 5
+    assert 1 <= smtp_server.sessions <= 2
+    assert smtp_server.logins == smtp_server.sessions
+
+
+def test_get_effdates(script_data, script_data_backfill):
+    assert get_effdates(script_data.apwx) == ["07/23/2025"]
+    assert get_effdates(script_data_backfill.apwx) == [
+        "07/21/2025",
+        "07/22/2025",
+        "07/23/2025",
+    ]
+
+
 def test_get_closed_accounts(script_data, mocker):
     mock_execute_sql_select = mocker.patch(
         f"{MODULE_NAME}.cns_closed_accts_email.execute_sql_select",
@@ -226,6 +546,296 @@ def test_get_closed_accounts(script_data, mocker):
     mock_execute_sql_select.assert_called_once()
 
 
+def test_get_closed_accounts_partitioned(script_data_partitioned, mocker):
+    # Closing dates on both sides of a new year, where MM/DD/YYYY text sorts wrong
+    close_dates = [datetime(2024, 12, 30), datetime(2025, 1, 2)]
+    rows = [
+        {
+            **account,
+            "CLOSEDATE": close_dates[i % 2].strftime("%m/%d/%Y"),
+            "CLOSEDATE_SORT": close_dates[i % 2],
+        }
+        for i, account in enumerate(EXPECTED_CLOSED_ACCOUNTS)
+    ]
+    single_query_rows = sorted(rows, key=lambda r: (r["CLOSEDATE_SORT"], r["ACCTNBR"]))
+
+    def partition_rows(conn, query, query_params):
+        assert query_params["partition_count"] == 3
+        return [
+            row
+            for row in single_query_rows
+            if row["ACCTNBR"] % 3 == query_params["partition_index"]
+        ]
+
+    mock_execute_sql_select = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.execute_sql_select",
+        side_effect=partition_rows,
+    )
+    mock_current_scn = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.current_scn",
+        return_value=1234567,
+    )
+    sessions = [mocker.MagicMock() for _ in range(3)]
+    script_data_partitioned.db_pool.acquire.side_effect = sessions
+    results = get_closed_accounts(script_data_partitioned)
+
+    # Same rows, in the same order, as the single query would return
+    assert results == single_query_rows
+    assert mock_execute_sql_select.call_count == 3
+    assert script_data_partitioned.db_pool.acquire.call_count == 3
+    query = mock_execute_sql_select.call_args.args[1]
+    assert "MOD(a.ACCTNBR, :partition_count) = :partition_index" in query
+
+    # The SCN is read once and every slice reads as of it on its own session
+    mock_current_scn.assert_called_once_with(script_data_partitioned.dbh)
+    for session in sessions:
+        cursor = session.__enter__.return_value.cursor.return_value.__enter__()
+        assert cursor.callproc.call_args_list == [
+            mocker.call("DBMS_FLASHBACK.ENABLE_AT_SYSTEM_CHANGE_NUMBER", [1234567]),
+            mocker.call("DBMS_FLASHBACK.DISABLE"),
+        ]
+
+
+def test_initialize_partitioned(script_data_partitioned, mocker):
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.get_config",
+        return_value=script_data_partitioned.config,
+    )
+    mock_dna_db_connect = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.dna_db_connect"
+    )
+    conn = mock_dna_db_connect.return_value
+
+    script_data = initialize(script_data_partitioned.apwx)
+
+    # The main connection plus one session per partition
+    assert mock_dna_db_connect.call_count == 4
+    with script_data.db_pool.acquire() as pooled_conn:
+        assert pooled_conn is conn
+    close_connections(script_data)
+    assert conn.close.call_count == 3
+
+
+def test_initialize_without_partition_predicate(script_data_partitioned, mocker):
+    config = {
+        **script_data_partitioned.config,
+        "get_closed_accounts": "SELECT * FROM ACCT a WHERE a.CLOSEDATE >= :effdate",
+    }
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.get_config",
+        return_value=config,
+    )
+    mock_dna_db_connect = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.dna_db_connect"
+    )
+    script_data = initialize(script_data_partitioned.apwx)
+    assert script_data.db_pool is None
+    mock_dna_db_connect.assert_called_once()
+
+
+@pytest.mark.parametrize("missing_key", ["partition_predicate", "partition_merge_keys"])
+def test_initialize_incomplete_partition_config(
+    script_data_partitioned, mocker, missing_key
+):
+    config = dict(script_data_partitioned.config)
+    del config[missing_key]
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.get_config",
+        return_value=config,
+    )
+    mock_dna_db_connect = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.dna_db_connect"
+    )
+    with pytest.raises(ValueError, match=missing_key):
+        initialize(script_data_partitioned.apwx)
+    mock_dna_db_connect.assert_not_called()
+
+
+def _sent_accounts(*accounts: dict) -> list[dict]:
+    return [{**account, "RESULT": "Email Sent"} for account in accounts]
+
+
+def test_get_closed_accounts_watermark(script_data_watermark, mocker):
+    mock_execute_sql_select = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.execute_sql_select",
+        return_value=EXPECTED_CLOSED_ACCOUNTS,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.today_date",
+        return_value="07/23/2025",
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+    apwx = script_data_watermark.apwx
+
+    # First run has no watermark yet but already leaves out today's closures
+    get_closed_accounts(script_data_watermark)
+    query, query_params = mock_execute_sql_select.call_args.args[1:]
+    assert "{{watermark_predicate}}" not in query
+    assert "a.CLOSEDATE < TO_DATE(:wm_today, 'MM/DD/YYYY')" in query
+    assert query_params == {
+        "effdate": "07/23/2025",
+        "wm_closedate": "01/01/1900",
+        "wm_today": "07/23/2025",
+    }
+
+    advance_watermark(script_data_watermark, _sent_accounts(*EXPECTED_CLOSED_ACCOUNTS))
+    assert read_watermark(apwx.args.WATERMARK_FILE) == {"CLOSEDATE": "07/14/2025"}
+
+    # Next run only reads the days after the watermark
+    get_closed_accounts(script_data_watermark)
+    query, query_params = mock_execute_sql_select.call_args.args[1:]
+    assert "a.CLOSEDATE > TO_DATE(:wm_closedate, 'MM/DD/YYYY')" in query
+    assert query_params == {
+        "effdate": "07/23/2025",
+        "wm_closedate": "07/14/2025",
+        "wm_today": "07/23/2025",
+    }
+
+    # Full rescan ignores the watermark
+    apwx.args.FULL_RESCAN_YN = "Y"
+    get_closed_accounts(script_data_watermark)
+    query, query_params = mock_execute_sql_select.call_args.args[1:]
+    assert ":wm_closedate" not in query
+    assert query_params == {"effdate": "07/23/2025"}
+
+
+def test_advance_watermark_never_moves_back(script_data_watermark, mocker):
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+    watermark_file = script_data_watermark.apwx.args.WATERMARK_FILE
+    advance_watermark(script_data_watermark, _sent_accounts(*EXPECTED_CLOSED_ACCOUNTS))
+    older_account = {**EXPECTED_CLOSED_ACCOUNTS[0], "CLOSEDATE": "12/31/2024"}
+    advance_watermark(script_data_watermark, _sent_accounts(older_account))
+    assert read_watermark(watermark_file) == {"CLOSEDATE": "07/14/2025"}
+
+    newer_account = {**older_account, "CLOSEDATE": "01/02/2026", "ACCTNBR": 1}
+    advance_watermark(script_data_watermark, _sent_accounts(newer_account))
+    assert read_watermark(watermark_file) == {"CLOSEDATE": "01/02/2026"}
+
+
+def test_advance_watermark_dry_run(script_data_watermark, mocker):
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+    apwx = script_data_watermark.apwx
+    apwx.args.SEND_EMAIL_YN = "N"
+    accounts = [
+        {**account, "RESULT": "Email Send Disabled"}
+        for account in EXPECTED_CLOSED_ACCOUNTS
+    ]
+    advance_watermark(script_data_watermark, accounts)
+    assert read_watermark(apwx.args.WATERMARK_FILE) is None
+
+    # A local run does not send either
+    apwx.args.SEND_EMAIL_YN = "Y"
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=True,
+    )
+    advance_watermark(script_data_watermark, _sent_accounts(*EXPECTED_CLOSED_ACCOUNTS))
+    assert read_watermark(apwx.args.WATERMARK_FILE) is None
+
+    # Nor does a run that sends every email to the tester
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+    apwx.args.TEST_EMAIL_ADDR = "test_closed_accts_email@firsttechfed.com"
+    advance_watermark(script_data_watermark, _sent_accounts(*EXPECTED_CLOSED_ACCOUNTS))
+    assert read_watermark(apwx.args.WATERMARK_FILE) is None
+
+
+def test_advance_watermark_stops_before_unfinished_days(script_data_watermark, mocker):
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.today_date",
+        return_value="07/20/2025",
+    )
+    watermark_file = script_data_watermark.apwx.args.WATERMARK_FILE
+    template = EXPECTED_CLOSED_ACCOUNTS[1]
+    accounts = _sent_accounts(
+        {**template, "CLOSEDATE": "07/14/2025", "ACCTNBR": 3},
+        {**template, "CLOSEDATE": "07/15/2025", "ACCTNBR": 2},
+        {**template, "CLOSEDATE": "07/20/2025", "ACCTNBR": 1},
+    )
+
+    # Today's closures may still be posting, so today is not covered, but the
+    # account emailed today is recorded so that it is not emailed again
+    advance_watermark(script_data_watermark, accounts)
+    assert read_watermark(watermark_file) == {
+        "CLOSEDATE": "07/15/2025",
+        "SENT": {"07/20/2025": [1]},
+    }
+
+    # A failed email keeps its whole closing day for the next run
+    accounts = _sent_accounts(
+        {**template, "CLOSEDATE": "07/16/2025", "ACCTNBR": 9},
+        {**template, "CLOSEDATE": "07/17/2025", "ACCTNBR": 8},
+        {**template, "CLOSEDATE": "07/18/2025", "ACCTNBR": 7},
+    )
+    accounts[1]["RESULT"] = "Email Failed"
+    advance_watermark(script_data_watermark, accounts)
+    assert read_watermark(watermark_file) == {
+        "CLOSEDATE": "07/16/2025",
+        "SENT": {"07/20/2025": [1], "07/18/2025": [7]},
+    }
+
+
+def test_run_does_not_resend_held_back_days(script_data_watermark, mocker):
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.initialize",
+        return_value=script_data_watermark,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.get_closed_accounts",
+        side_effect=lambda script_data, effdate: [
+            dict(account) for account in EXPECTED_CLOSED_ACCOUNTS
+        ],
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.is_local_environment",
+        return_value=False,
+    )
+    mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.today_date",
+        return_value="07/23/2025",
+    )
+    failing_address = EXPECTED_CLOSED_ACCOUNTS[2]["EMAILADDR"]
+
+    def send(script_data, from_address, to_address, email_message):
+        if to_address == failing_address:
+            raise smtplib.SMTPDataError(554, b"Transaction failed")
+
+    # The first run fails one email, which holds its closing day back
+    mock_send = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.send_smtp_request", side_effect=send
+    )
+    assert run(script_data_watermark.apwx) is True
+    first_run_addresses = {c.args[2] for c in mock_send.call_args_list}
+    assert failing_address in first_run_addresses
+    assert len(first_run_addresses) == 5
+    watermark_file = script_data_watermark.apwx.args.WATERMARK_FILE
+    assert read_watermark(watermark_file)["CLOSEDATE"] == WATERMARK_START
+
+    # The second run reads the day again but only retries the failed email
+    mock_send = mocker.patch(
+        f"{MODULE_NAME}.cns_closed_accts_email.send_smtp_request",
+        return_value=None,
+    )
+    assert run(script_data_watermark.apwx) is True
+    assert [c.args[2] for c in mock_send.call_args_list] == [failing_address]
+    assert read_watermark(watermark_file) == {"CLOSEDATE": "07/14/2025"}
+
+
 def test_is_fdi(script_data):
     assert is_fdi(EXPECTED_CLOSED_ACCOUNTS[7]) is True
     # is FDI but FDI_INACTIVE_DATE is null
@@ -270,3 +880,63 @@ def test_validate_email():
     assert validate_email("test") is False
     assert validate_email("") is False
     assert validate_email(None) is False
+
+
+def test_send_smtp_request_resumes_tls_session(script_data_smtp, smtp_server):
+    message = generate_email_message(
+        "member.communications@firsttechfed.com", "keith_tester0@gmail.com", "Hi"
+    )
+    for _ in range(3):
+        send_smtp_request(
+            script_data_smtp,
+            "member.communications@firsttechfed.com",
+            "keith_tester0@gmail.com",
+            message,
+        )
+        # Force the next message onto a new connection
+        close_connections(script_data_smtp)
+
+    # Only the first connection needs a full handshake
+    tls_sessions = script_data_smtp.tls_sessions
+    assert tls_sessions.handshakes == 3
+    assert tls_sessions.resumed == 2
+    assert smtp_server.resumed_handshakes == 2
+
+
+@pytest.mark.parametrize("session_limit_verb", [None, "MAIL", "RCPT", "DATA"])
+def test_send_smtp_request_reuses_session(
+    script_data_smtp, smtp_server, session_limit_verb
+):
+    # The relay drops a session after two messages, silently or with a 421 reply,
+    # forcing one reconnect
+    smtp_server.max_messages_per_session = 2
+    smtp_server.session_limit_verb = session_limit_verb
+    message = generate_email_message(
+        "member.communications@firsttechfed.com", "keith_tester0@gmail.com", "Hi"
+    )
+    for _ in range(3):
+        send_smtp_request(
+            script_data_smtp,
+            "member.communications@firsttechfed.com",
+            "keith_tester0@gmail.com",
+            message,
+        )
+    close_connections(script_data_smtp)
+
+    assert smtp_server.delivered == ["gmail.com"] * 3
+    assert smtp_server.sessions == 2
+    assert smtp_server.logins == 2
+    assert script_data_smtp.smtp_sessions.sessions_opened == 2
+
+
+def test_get_ssl_context(script_data, script_data_smtp):
+    assert script_data.ssl_context.verify_mode == ssl.CERT_REQUIRED
+    assert script_data_smtp.ssl_context.check_hostname is True
+
+    script_data.apwx.args.SMTP_TLS_VERIFY_YN = "N"
+    try:
+        ssl_context = get_ssl_context(script_data.apwx)
+    finally:
+        script_data.apwx.args.SMTP_TLS_VERIFY_YN = "Y"
+    assert ssl_context.verify_mode == ssl.CERT_NONE
+    assert ssl_context.check_hostname is False